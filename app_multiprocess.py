@@ -9,19 +9,29 @@ Starts and manages all 3 processes:
 Handles all IPC communication setup
 """
 
+import logging
 import multiprocessing
+import queue
 import time
 import signal
+import threading
 import sys
 import os
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+from waitress import serve
+import orjson
 import uuid
+import zlib
 
 # Import our process modules
 from download_manager import download_manager_process
 from monitor_service import monitoring_service_process
 # Import shared utilities
-from utils import validate_repo_id, validate_model_path, scan_models
+from utils import validate_repo_id, validate_model_path, scan_models, invalidate_model_cache, setup_logging
+
+log = logging.getLogger("hfd")
 
 
 # ============== SHARED UTILITIES ==============
@@ -36,10 +46,13 @@ from utils import validate_repo_id, validate_model_path, scan_models
 
 # ============== GLOBAL STATE MANAGER ==============
 
+# Bytes reserved for the serialized download status
+STATUS_JSON_SIZE = 4096
+
 class AppState:
     """Thread-safe application state using multiprocessing Manager"""
     def __init__(self, manager):
-        self.download_status = manager.dict({
+        initial_status = {
             "progress": 0,
             "status": "idle",
             "current_file": "",
@@ -47,41 +60,112 @@ class AppState:
             "downloaded_bytes": 0,
             "total_bytes": 0,
             "repo_id": "",
+            "task_id": None,
             "start_time": None
-        })
+        }
+        # The status lives as pre-serialized JSON in shared memory: the status
+        # processor writes it, and /api/status readers in the web server copy
+        # it out directly instead of going through the manager process
+        self._status_buffer = multiprocessing.Array('c', STATUS_JSON_SIZE)
+        self._status_buffer.value = orjson.dumps(initial_status)
         self.pending_tasks = manager.dict()  # Track pending responses
+        self._current_status = None  # Writer-side copy, see update_status()
+    
+    @property
+    def status_json(self):
+        """Current download status as JSON bytes"""
+        with self._status_buffer.get_lock():
+            return self._status_buffer.value
+    
+    @property
+    def download_status(self):
+        """Current download status as a dict"""
+        return orjson.loads(self.status_json)
     
     def update_status(self, **kwargs):
-        """Update download status"""
-        for key, value in kwargs.items():
-            self.download_status[key] = value
+        """Update download status
+        
+        Only the status processor writes, so it keeps the current status in
+        its own process and publishes each update as one JSON blob, without
+        first reading the old state back.
+        """
+        if self._current_status is None:
+            self._current_status = self.download_status
+        previous = self._current_status
+        status = {**previous, **kwargs}
+        
+        # Calculate ETA (only when progress moved) on the monotonic clock; start_monotonic
+        # is kept out of the published status, where start_time is wall-clock time
+        start_monotonic = status.pop('start_monotonic', None)
+        if status.get('status') in ('starting', 'completed', 'error') or not status.get('progress'):
+            # Nothing left to estimate (or nothing to estimate from yet)
+            status.pop('eta', None)
+        elif start_monotonic and status['progress'] != previous.get('progress'):
+            elapsed = time.monotonic() - start_monotonic
+            status['eta'] = (elapsed / status['progress']) * (100 - status['progress'])
         
-        # Calculate ETA
-        if self.download_status.get('start_time') and self.download_status.get('progress', 0) > 0:
-            elapsed = time.time() - self.download_status['start_time']
-            if self.download_status['progress'] > 0:
-                eta = (elapsed / self.download_status['progress']) * (100 - self.download_status['progress'])
-                self.download_status['eta'] = eta
+        body = orjson.dumps(status)
+        if len(body) >= STATUS_JSON_SIZE:
+            # Shorten current_file (e.g. a long error message) to fit the buffer
+            current_file = status.get('current_file') or ''
+            keep = max(0, len(current_file.encode()) - (len(body) - STATUS_JSON_SIZE) - 16)
+            status['current_file'] = current_file.encode()[:keep].decode(errors='ignore') + '...'
+            body = orjson.dumps(status)
+        if len(body) >= STATUS_JSON_SIZE:
+            # Still too large: publish the numbers without the free-form strings
+            status = {**status, 'current_file': '', 'repo_id': ''}
+            body = orjson.dumps(status)
+        with self._status_buffer.get_lock():
+            self._status_buffer.value = body
+        if start_monotonic:
+            status['start_monotonic'] = start_monotonic
+        self._current_status = status
 
 
 # ============== FLASK WEB SERVER ==============
 
+# Concurrent /api/status/stream connections, and seconds between keep-alives
+# (a write is the only way to notice a closed stream and free its slot)
+STATUS_STREAM_LIMIT = 4
+STATUS_STREAM_KEEPALIVE = 1
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify() and request.get_json()"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 def create_flask_app(app_state, task_queue, monitor_requests_queue):
     """Create Flask application with IPC communication"""
     
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
     app.config['SECRET_KEY'] = 'your-secret-key'
     
+    # Compress JSON/HTML responses; the model list is highly repetitive
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_MIN_SIZE'] = 2048
+    Compress(app)
+    
     # CONFIGURATION
     base_url = "/hf-downloader"   # Set this to match your Caddy handle_path
     
-    # Route helper function
-    def add_url_rule_with_prefix(path, endpoint, view_func, methods=None):
-        """Register routes with and without base_url prefix"""
-        app.add_url_rule(path, endpoint, view_func, methods=methods)
-        if base_url:
-            prefixed_path = f"{base_url}{path}"
-            app.add_url_rule(prefixed_path, f"{endpoint}_prefixed", view_func, methods=methods)
+    # Serve routes with and without the base_url prefix from a single URL rule each:
+    # prefixed requests have base_url moved from PATH_INFO to SCRIPT_NAME before routing
+    def strip_base_url(wsgi_app):
+        def middleware(environ, start_response):
+            path = environ.get('PATH_INFO', '')
+            if path == base_url or path.startswith(f"{base_url}/"):
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + base_url
+                environ['PATH_INFO'] = path[len(base_url):] or '/'
+            return wsgi_app(environ, start_response)
+        return middleware
+    
+    if base_url:
+        app.wsgi_app = strip_base_url(app.wsgi_app)
     
     @app.context_processor
     def inject_base_url():
@@ -89,34 +173,23 @@ def create_flask_app(app_state, task_queue, monitor_requests_queue):
     
     @app.before_request
     def log_request():
-        print(f"📨 {request.method} {request.path}")
+        log.debug("📨 %s %s", request.method, request.path)
     
-    def index():
-        return render_template('index.html')
+    # Serializes the busy check with queueing, so concurrent POSTs cannot both start a download
+    download_lock = threading.Lock()
     
-    @app.route('/favicon.ico')
-    def favicon():
-        return ('', 204)
+    def download_in_progress():
+        if app_state.download_status["status"] in ("starting", "downloading"):
+            return True
+        # Queued, but not yet picked up by the download manager
+        return any(task['type'] == 'download' for task in app_state.pending_tasks.values())
     
-    def start_download():
-        data = request.get_json() or {}
-        repo_id = data.get('repo_id', '').strip()
-        quant_pattern = data.get('quant_pattern', '').strip()
-
-        if not repo_id:
-            return jsonify({'error': 'Repository ID is required'}), 400
-            
-        if not validate_repo_id(repo_id):
-            return jsonify({'error': 'Repository ID should be in format: username/model-name'}), 400
-
-        if app_state.download_status["status"] == "downloading":
-            return jsonify({'error': 'Download already in progress'}), 400
-
-        # Generate task ID and send to download manager
+    def queue_download(repo_id, quant_pattern):
+        """Send a download task to the download manager and start monitoring it"""
         task_id = str(uuid.uuid4())
         task = {
             'task_id': task_id,
-            'type': 'download',
+            'type': 'download',  # Update is same as download
             'repo_id': repo_id,
             'quant_pattern': quant_pattern
         }
@@ -132,17 +205,88 @@ def create_flask_app(app_state, task_queue, monitor_requests_queue):
             'type': 'start_monitor',
             'repo_id': repo_id,
             'local_dir': f"/models/{repo_id}",
-            'total_expected_bytes': 0  # Will be updated by download manager
+            'total_expected_bytes': 0  # Sent later via 'set_expected' once known
         })
         
+        return task_id
+    
+    def index():
+        return render_template('index.html')
+    
+    def start_download():
+        data = request.get_json() or {}
+        repo_id = data.get('repo_id', '').strip()
+        quant_pattern = data.get('quant_pattern', '').strip()
+
+        if not repo_id:
+            return jsonify({'error': 'Repository ID is required'}), 400
+            
+        if not validate_repo_id(repo_id):
+            return jsonify({'error': 'Repository ID should be in format: username/model-name'}), 400
+
+        with download_lock:
+            if download_in_progress():
+                return jsonify({'error': 'Download already in progress'}), 429
+            task_id = queue_download(repo_id, quant_pattern)
         return jsonify({'message': 'Download started', 'task_id': task_id})
 
     def get_status():
-        return jsonify(dict(app_state.download_status))
-
+        # ETag from the published JSON: unchanged polls get an empty 304, which
+        # the browser cache answers with the previous body
+        body = app_state.status_json
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(f"{zlib.crc32(body):08x}")
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    # Serialized model list, reused while scan_models() returns the same list
+    models_json = (None, b'')
+    # Last finished download whose directory was dropped from the scan cache
+    last_finished_task = None
+    
+    # Each open event stream holds a server thread, so only a few are allowed;
+    # refused clients fall back to polling /api/status
+    stream_slots = threading.BoundedSemaphore(STATUS_STREAM_LIMIT)
+    
+    def status_stream():
+        if not stream_slots.acquire(blocking=False):
+            return jsonify({'error': 'Too many status streams'}), 503
+        
+        def generate():
+            # Push changes only: clients fetch the current state from /api/status
+            last = app_state.status_json
+            quiet = 0.0
+            yield b': connected\n\n'  # Sends the headers right away
+            while True:
+                time.sleep(STATUS_FLUSH_INTERVAL)
+                body = app_state.status_json
+                if body != last:
+                    last = body
+                    quiet = 0.0
+                    yield b'data: ' + body + b'\n\n'
+                else:
+                    quiet += STATUS_FLUSH_INTERVAL
+                    if quiet >= STATUS_STREAM_KEEPALIVE:
+                        # Lets the server notice clients that went away, within seconds
+                        quiet = 0.0
+                        yield b': keep-alive\n\n'
+        
+        response = app.response_class(generate(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.call_on_close(stream_slots.release)
+        return response
+    
     def api_models():
+        nonlocal models_json, last_finished_task
+        status = app_state.download_status
+        if status['status'] in ('completed', 'error') and status.get('task_id') != last_finished_task:
+            last_finished_task = status.get('task_id')
+            if status.get('repo_id'):
+                invalidate_model_cache(f"/models/{status['repo_id']}")
         models = scan_models()
-        return jsonify(models)
+        if models is not models_json[0]:
+            models_json = (models, orjson.dumps(models))
+        return app.response_class(models_json[1], mimetype='application/json')
 
     def api_update_model():
         data = request.get_json() or {}
@@ -152,26 +296,10 @@ def create_flask_app(app_state, task_queue, monitor_requests_queue):
         if not validate_repo_id(repo_id):
             return jsonify({'error': 'Invalid repository ID'}), 400
 
-        # Generate task ID and send to download manager
-        task_id = str(uuid.uuid4())
-        task = {
-            'task_id': task_id,
-            'type': 'download',  # Update is same as download
-            'repo_id': repo_id,
-            'quant_pattern': quant_pattern
-        }
-        
-        app_state.pending_tasks[task_id] = task
-        task_queue.put(task)
-        
-        # Start monitoring
-        monitor_requests_queue.put({
-            'type': 'start_monitor',
-            'repo_id': repo_id,
-            'local_dir': f"/models/{repo_id}",
-            'total_expected_bytes': 0
-        })
-        
+        with download_lock:
+            if download_in_progress():
+                return jsonify({'error': 'Download already in progress'}), 429
+            task_id = queue_download(repo_id, quant_pattern)
         return jsonify({'message': f'Update started for {repo_id}', 'task_id': task_id})
 
     def api_delete_model():
@@ -195,36 +323,69 @@ def create_flask_app(app_state, task_queue, monitor_requests_queue):
         return jsonify({'message': f'Delete started for {model_path}', 'task_id': task_id})
 
     # Register all routes
-    add_url_rule_with_prefix('/', 'index', index)
-    add_url_rule_with_prefix('/api/download', 'start_download', start_download, methods=['POST'])
-    add_url_rule_with_prefix('/api/status', 'get_status', get_status)
-    add_url_rule_with_prefix('/api/list', 'api_models', api_models)
-    add_url_rule_with_prefix('/api/update', 'api_update_model', api_update_model, methods=['POST'])
-    add_url_rule_with_prefix('/api/delete', 'api_delete_model', api_delete_model, methods=['POST'])
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/api/download', 'start_download', start_download, methods=['POST'])
+    app.add_url_rule('/api/status', 'get_status', get_status)
+    app.add_url_rule('/api/status/stream', 'status_stream', status_stream)
+    app.add_url_rule('/api/list', 'api_models', api_models)
+    app.add_url_rule('/api/update', 'api_update_model', api_update_model, methods=['POST'])
+    app.add_url_rule('/api/delete', 'api_delete_model', api_delete_model, methods=['POST'])
     
     return app
 
 
 # ============== STATUS UPDATE PROCESSOR ==============
 
+# Minimum seconds between writes of coalesced status updates to shared state
+STATUS_FLUSH_INTERVAL = 0.5
+
+
 def status_update_processor(status_queue, response_queue, app_state, monitor_requests_queue):
     """Process status updates from download manager and monitoring service"""
+    setup_logging()
     print("📡 Status Update Processor Started")
     
+    pending = {}        # Updates received but not yet written to shared state
+    last_flush = 0.0
+    last_status = app_state.download_status['status']
+    
     while True:
         try:
             # Check for status updates (blocking with timeout)
             try:
-                status_update = status_queue.get(timeout=1)
-                print(f"📊 Status update: {status_update}")
+                updates = [status_queue.get(timeout=STATUS_FLUSH_INTERVAL if pending else 1)]
+                
+                # Coalesce everything already queued into a single write
+                while True:
+                    try:
+                        updates.append(status_queue.get_nowait())
+                    except queue.Empty:
+                        break
+            except queue.Empty:
+                updates = []  # Timeout, continue
+            
+            for update in updates:
+                # Monitor ticks (the ones carrying monitor_time) that were queued before
+                # the monitor stopped must not turn a finished download back into 'downloading'
+                if 'monitor_time' in update and last_status in ('completed', 'error'):
+                    continue
+                last_status = update.get('status', last_status)
+                pending.update(update)
+            
+            # Write at most once per STATUS_FLUSH_INTERVAL; final states go out immediately
+            now = time.monotonic()
+            if pending and (now - last_flush >= STATUS_FLUSH_INTERVAL
+                            or pending.get('status') in ('completed', 'error')):
+                status_update, pending = pending, {}
+                last_flush = now
+                
+                log.debug("📊 Status update: %s", status_update)
                 app_state.update_status(**status_update)
-            except:
-                pass  # Timeout, continue
             
             # Check for task responses (non-blocking)
             try:
                 response = response_queue.get_nowait()
-                print(f"📨 Task response: {response}")
+                log.debug("📨 Task response: %s", response)
                 
                 task_id = response.get('task_id')
                 if task_id and task_id in app_state.pending_tasks:
@@ -232,9 +393,16 @@ def status_update_processor(status_queue, response_queue, app_state, monitor_req
                     task = app_state.pending_tasks[task_id]
                     del app_state.pending_tasks[task_id]
                     
-                    if task['type'] == 'download' and response['success']:
-                        # Download completed, stop monitoring after a delay
+                    if task['type'] == 'download':
+                        # Download finished (successfully or not), stop monitoring
                         monitor_requests_queue.put({'type': 'stop_monitor'})
+
+                        # A failure reported without an 'error' status (e.g. rejected by the
+                        # download manager) must still clear the busy state used by /api/download
+                        if not response['success'] and last_status not in ('completed', 'error'):
+                            pending = {}
+                            last_status = 'error'
+                            app_state.update_status(status='error', progress=0, current_file=response['message'], task_id=task_id)
                     
                     print(f"✅ Task {task_id} completed: {response['message']}")
                     
@@ -250,6 +418,7 @@ def status_update_processor(status_queue, response_queue, app_state, monitor_req
 
 def main():
     """Main function to orchestrate all processes"""
+    setup_logging()
     print("\n" + "="*60)
     print("🚀 STARTING HUGGINGFACE MODEL DOWNLOADER - MULTI-PROCESS")
     print("="*60)
@@ -266,7 +435,7 @@ def main():
     task_queue = manager.Queue()           # Web -> Download Manager
     status_queue = manager.Queue()         # Download Manager/Monitor -> Status Processor
     response_queue = manager.Queue()       # Download Manager -> Status Processor
-    monitor_requests_queue = manager.Queue()  # Status Processor -> Monitor Service
+    monitor_requests_queue = manager.Queue()  # Web/Download Manager/Status Processor -> Monitor Service
     
     # Create shared state
     app_state = AppState(manager)
@@ -277,7 +446,7 @@ def main():
     # 1. Download Manager Process
     download_process = multiprocessing.Process(
         target=download_manager_process,
-        args=(task_queue, status_queue, response_queue),
+        args=(task_queue, status_queue, response_queue, monitor_requests_queue),
         name="DownloadManager"
     )
     download_process.start()
@@ -332,8 +501,12 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     
     try:
-        # Start Flask app (this blocks)
-        flask_app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
+        # Start web server (this blocks)
+        if os.environ.get("FLASK_DEBUG") == "1":
+            # The reloader would re-exec this process and orphan the workers above
+            flask_app.run(debug=True, use_reloader=False, host='0.0.0.0', port=5000, threaded=True)
+        else:
+            serve(flask_app, host='0.0.0.0', port=5000, threads=16, connection_limit=512)
     except KeyboardInterrupt:
         signal_handler(None, None)
 
@@ -6,53 +6,150 @@ Communicates via IPC queues only
 """
 
 import os
+import re
 import time
+import logging
+import fnmatch
+import functools
 import traceback
-import shutil
-from pathlib import Path
+import orjson
+
+# huggingface_hub reads its transfer settings at import time, so defaults
+# must be in place before the import below (env still wins when set)
+os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+# huggingface_hub fails every download when hf_transfer is enabled but not
+# installed; fall back to its built-in downloader (parallel across files) instead
+HF_TRANSFER_FALLBACK = False
+if os.environ["HF_HUB_ENABLE_HF_TRANSFER"] == "1":
+    try:
+        import hf_transfer  # noqa: F401
+    except ImportError:
+        os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
+        HF_TRANSFER_FALLBACK = True
+
+# Parallel file downloads per repository (HF_MAX_WORKERS overrides). Only used
+# without hf_transfer: huggingface_hub then fetches files one at a time, each
+# over many ranged connections, and ignores max_workers
+MAX_WORKERS = int(os.getenv("HF_MAX_WORKERS", min(16, (os.cpu_count() or 4) * 2)))
+
 from huggingface_hub import snapshot_download, HfApi
 from huggingface_hub.utils import HfHubHTTPError
 
 # Import shared utilities
-from utils import get_file_size_from_bytes, validate_repo_id, validate_model_path
+from utils import get_file_size_from_bytes, get_directory_size, validate_repo_id, validate_model_path, setup_logging, ensure_dir, forget_dir
+
+log = logging.getLogger("hfd")
+
+# Shared client so metadata calls reuse one HTTP connection pool
+_HF_API = HfApi()
+
+# Repository file tables: {repo_id: (commit sha, [(rfilename, size, blob_name)])},
+# also kept on disk so they survive restarts
+_repo_files_cache = {}
+REPO_INFO_CACHE_DIR = "/models/.cache/repo_info"
+
+
+@functools.lru_cache(maxsize=64)
+def compile_allow_patterns(allow_patterns):
+    """Compile a tuple of glob allow_patterns into a filename predicate (None when there is no filter)
+    
+    Uses the same fnmatch semantics as snapshot_download's own filtering,
+    so the expected size matches the files that are actually fetched.
+    The usual single '*text*' pattern becomes a plain substring test;
+    anything else is one regex. Cached, so retries and updates with the
+    same pattern reuse it.
+    """
+    if not allow_patterns:
+        return None
+    if len(allow_patterns) == 1:
+        pattern = allow_patterns[0]
+        core = pattern[1:-1]
+        if len(pattern) >= 2 and pattern[0] == pattern[-1] == '*' and not any(c in core for c in '*?['):
+            return lambda name: core in name
+    regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in allow_patterns))
+    return lambda name: regex.match(name) is not None
+
+
+def get_repo_files(repo_id):
+    """Return [(rfilename, size, blob_name)] for a repository
+    
+    blob_name is the file's name under the cache's blobs/ directory (the
+    LFS sha256, or the git blob id for regular files). Tables are cached
+    in memory and under REPO_INFO_CACHE_DIR, keyed by the repository's
+    current commit: a cheap repo_info call (without files_metadata) checks
+    that sha, and the full metadata is only fetched when it changed.
+    """
+    sha = _HF_API.repo_info(repo_id).sha
+    
+    cached = _repo_files_cache.get(repo_id)
+    if cached and cached[0] == sha:
+        return cached[1]
+    
+    cache_path = os.path.join(REPO_INFO_CACHE_DIR, repo_id.replace('/', '--') + '.json')
+    try:
+        with open(cache_path, 'rb') as f:
+            data = orjson.loads(f.read())
+        if data['sha'] == sha:
+            files = [tuple(entry) for entry in data['files']]
+            _repo_files_cache[repo_id] = (sha, files)
+            return files
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    
+    repo_info = _HF_API.repo_info(repo_id, revision=sha, files_metadata=True)
+    files = [
+        (sibling.rfilename, sibling.size or 0, sibling.lfs['sha256'] if sibling.lfs else sibling.blob_id)
+        for sibling in repo_info.siblings
+    ]
+    _repo_files_cache[repo_id] = (sha, files)
+    
+    try:
+        ensure_dir(REPO_INFO_CACHE_DIR)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps({'sha': sha, 'files': files}))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.debug("Could not cache repository info for %s: %s", repo_id, e)
+    return files
 
 
 def get_repo_info_with_patterns(repo_id, allow_patterns=None):
-    """Get repository info and calculate total expected download size"""
+    """Get the files matching allow_patterns and their total expected download size
+    
+    Returns (total_size, file_count, expected_files) where expected_files is
+    the matching subset of get_repo_files().
+    """
     try:
         print(f"🔍 Fetching repository info for {repo_id}...")
-        api = HfApi()
-        repo_info = api.repo_info(repo_id, files_metadata=True)
+        repo_files = get_repo_files(repo_id)
         
         total_size = 0
-        file_count = 0
+        expected_files = []
+        matcher = compile_allow_patterns(tuple(allow_patterns or ()))
         
-        print(f"📂 Repository has {len(repo_info.siblings)} files")
+        print(f"📂 Repository has {len(repo_files)} files")
         
-        for sibling in repo_info.siblings:
+        for rfilename, size, blob_name in repo_files:
             # Check if file matches patterns (if specified)
-            if allow_patterns:
-                matches_pattern = any(
-                    pattern.replace('*', '') in sibling.rfilename 
-                    for pattern in allow_patterns
-                )
-                if not matches_pattern:
-                    continue
+            if matcher and not matcher(rfilename):
+                continue
             
-            if hasattr(sibling, 'size') and sibling.size:
-                total_size += sibling.size
-                file_count += 1
-                print(f"  📄 {sibling.rfilename}: {get_file_size_from_bytes(sibling.size)}")
+            if size:
+                total_size += size
+                expected_files.append((rfilename, size, blob_name))
+                log.debug("  📄 %s: %s", rfilename, size)
         
-        print(f"✅ Total expected: {get_file_size_from_bytes(total_size)} ({file_count} files)")
-        return total_size, file_count, repo_info
+        print(f"✅ Total expected: {get_file_size_from_bytes(total_size)} ({len(expected_files)} files)")
+        return total_size, len(expected_files), expected_files
     except Exception as e:
         print(f"❌ Failed to get repo info: {e}")
         traceback.print_exc()
-        return 0, 0, None
+        return 0, 0, []
 
 
-def perform_download(repo_id, quant_pattern, status_queue):
+def perform_download(repo_id, quant_pattern, status_queue, monitor_requests_queue, task_id=None):
     """Perform the actual download operation"""
     try:
         print(f"\n=== DOWNLOAD STARTED ===")
@@ -68,11 +165,13 @@ def perform_download(repo_id, quant_pattern, status_queue):
             'downloaded_bytes': 0,
             'total_bytes': 0,
             'repo_id': repo_id,
-            'start_time': time.time()
+            'task_id': task_id,  # Lets the page tell this download's status from the previous one
+            'start_time': time.time(),
+            'start_monotonic': time.monotonic()  # For the ETA: same clock across processes, immune to wall-clock jumps
         })
 
         local_dir = f"/models/{repo_id}"
-        os.makedirs(local_dir, exist_ok=True)
+        ensure_dir(local_dir)
 
         allow_patterns = [f"*{quant_pattern}*"] if quant_pattern.strip() else None
 
@@ -83,13 +182,19 @@ def perform_download(repo_id, quant_pattern, status_queue):
             'current_file': 'Getting repository information...'
         })
 
-        total_expected_bytes, expected_files, repo_info = get_repo_info_with_patterns(repo_id, allow_patterns)
+        total_expected_bytes, expected_count, expected_files = get_repo_info_with_patterns(repo_id, allow_patterns)
         
         if total_expected_bytes > 0:
-            print(f"✅ Expected download size: {get_file_size_from_bytes(total_expected_bytes)} ({expected_files} files)")
+            print(f"✅ Expected download size: {get_file_size_from_bytes(total_expected_bytes)} ({expected_count} files)")
             status_queue.put({
                 'total_bytes': total_expected_bytes,
-                'current_file': f"Expected: {get_file_size_from_bytes(total_expected_bytes)} ({expected_files} files)"
+                'current_file': f"Expected: {get_file_size_from_bytes(total_expected_bytes)} ({expected_count} files)"
+            })
+            # Let the monitor measure progress per expected file
+            monitor_requests_queue.put({
+                'type': 'set_expected',
+                'repo_id': repo_id,
+                'expected_files': expected_files
             })
         else:
             print(f"⚠️ Could not determine download size - progress will be estimated")
@@ -97,7 +202,7 @@ def perform_download(repo_id, quant_pattern, status_queue):
 
         # Set custom cache directory within models folder
         cache_dir = "/models/.cache"
-        os.makedirs(cache_dir, exist_ok=True)
+        ensure_dir(cache_dir)
         
         print(f"🚀 Starting download...")
         
@@ -111,22 +216,15 @@ def perform_download(repo_id, quant_pattern, status_queue):
             allow_patterns=allow_patterns,
             resume_download=True,
             local_dir_use_symlinks=False,
-            cache_dir=cache_dir
+            cache_dir=cache_dir,
+            max_workers=MAX_WORKERS
         )
         
         # Download completed successfully
         print(f"✅ Download completed successfully")
         
         # Calculate final size
-        total_downloaded = 0
-        if os.path.exists(local_dir):
-            local_path = Path(local_dir)
-            for file_path in local_path.rglob('*'):
-                if file_path.is_file():
-                    try:
-                        total_downloaded += file_path.stat().st_size
-                    except (OSError, IOError):
-                        continue
+        total_downloaded = get_directory_size(local_dir)
         
         status_queue.put({
             'progress': 100,
@@ -149,6 +247,31 @@ def perform_download(repo_id, quant_pattern, status_queue):
         return False, error_msg
 
 
+def _purge(path):
+    """Delete a directory tree in a single pass, returning (file_count, total_bytes)"""
+    if os.path.islink(path):
+        # Same guard as shutil.rmtree: never follow a symlink out of /models
+        raise OSError(f"Cannot delete a symbolic link: {path}")
+    
+    file_count = 0
+    total_bytes = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                count, size = _purge(entry.path)
+                file_count += count
+                total_bytes += size
+            else:
+                try:
+                    total_bytes += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+                os.unlink(entry.path)
+                file_count += 1
+    os.rmdir(path)
+    return file_count, total_bytes
+
+
 def perform_delete(model_path):
     """Perform model deletion"""
     try:
@@ -156,23 +279,9 @@ def perform_delete(model_path):
             return False, "Invalid model path: must be within /models/ directory"
         
         if os.path.exists(model_path):
-            # Get info before deletion
-            try:
-                total_size = 0
-                file_count = 0
-                for dirpath, dirnames, filenames in os.walk(model_path):
-                    file_count += len(filenames)
-                    for filename in filenames:
-                        filepath = os.path.join(dirpath, filename)
-                        try:
-                            total_size += os.path.getsize(filepath)
-                        except (OSError, IOError):
-                            pass
-                size_info = f"{file_count} files, {get_file_size_from_bytes(total_size)}"
-            except Exception:
-                size_info = "unknown size"
-            
-            shutil.rmtree(model_path)
+            file_count, total_size = _purge(model_path)
+            forget_dir(model_path)
+            size_info = f"{file_count} files, {get_file_size_from_bytes(total_size)}"
             return True, f'Model deleted successfully ({size_info})'
         else:
             return False, 'Model path not found'
@@ -181,12 +290,13 @@ def perform_delete(model_path):
         return False, f'Error deleting model: {str(e)}'
 
 
-def download_manager_process(task_queue, status_queue, response_queue):
+def download_manager_process(task_queue, status_queue, response_queue, monitor_requests_queue):
     """Main download manager process loop"""
+    setup_logging()
     print("🚀 Download Manager Process Started")
     
-    # Set HF_TRANSFER for faster downloads
-    os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
+    if HF_TRANSFER_FALLBACK:
+        print(f"⚠️ hf_transfer is not installed - using the standard downloader ({MAX_WORKERS} parallel files)")
     
     while True:
         try:
@@ -206,7 +316,7 @@ def download_manager_process(task_queue, status_queue, response_queue):
                     })
                     continue
                 
-                success, message = perform_download(repo_id, quant_pattern, status_queue)
+                success, message = perform_download(repo_id, quant_pattern, status_queue, monitor_requests_queue, task.get('task_id'))
                 response_queue.put({
                     'task_id': task.get('task_id'),
                     'success': success,
@@ -7,15 +7,21 @@ Communicates via IPC queues only
 
 import os
 import time
-import traceback
-from pathlib import Path
+import queue
+import logging
 
 # Import shared utilities
-from utils import get_file_size_from_bytes, calculate_downloaded_size
+from utils import get_file_size_from_bytes, DownloadSizeTracker, calculate_expected_progress, setup_logging
+
+log = logging.getLogger("hfd")
+
+# Seconds between progress measurements
+MONITOR_INTERVAL = 3
 
 
 def monitoring_service_process(status_queue, monitor_requests_queue):
     """Main monitoring service process loop"""
+    setup_logging()
     print("📊 Monitoring Service Process Started")
     
     # Track current monitoring state
@@ -24,21 +30,30 @@ def monitoring_service_process(status_queue, monitor_requests_queue):
     
     while True:
         try:
-            # Check for new monitoring requests (non-blocking)
+            # Wait for a monitoring request; the timeout doubles as the polling interval,
+            # so start/stop requests are handled immediately instead of after a sleep.
+            # With nothing to monitor, sleep until the next request arrives.
             try:
-                request = monitor_requests_queue.get_nowait()
-                print(f"📨 Monitor request: {request}")
+                request = monitor_requests_queue.get(timeout=MONITOR_INTERVAL if current_monitor else None)
+                log.debug("📨 Monitor request: %s %s", request['type'], request.get('repo_id', ''))
                 
                 if request['type'] == 'start_monitor':
                     current_monitor = {
                         'repo_id': request['repo_id'],
                         'local_dir': request['local_dir'],
                         'total_expected_bytes': request['total_expected_bytes'],
-                        'start_time': time.time()
+                        'start_time': time.monotonic(),
+                        'tracker': DownloadSizeTracker(request['local_dir'], "/models/.cache", request['repo_id'])
                     }
                     last_downloaded_bytes = 0
                     print(f"📊 Started monitoring {current_monitor['repo_id']}")
                     
+                elif request['type'] == 'set_expected':
+                    if current_monitor and current_monitor['repo_id'] == request['repo_id']:
+                        current_monitor['expected_files'] = request['expected_files']
+                        current_monitor['completed_files'] = set()
+                        current_monitor['total_expected_bytes'] = sum(size for _, size, _ in request['expected_files'])
+                    
                 elif request['type'] == 'stop_monitor':
                     if current_monitor:
                         print(f"🛑 Stopped monitoring {current_monitor['repo_id']}")
@@ -49,25 +64,35 @@ def monitoring_service_process(status_queue, monitor_requests_queue):
                     print("🛑 Monitoring Service shutting down")
                     break
                     
-            except:
+            except queue.Empty:
                 # No request waiting, continue monitoring
                 pass
             
             # Perform monitoring if active
             if current_monitor:
-                loop_start = time.time()
+                loop_start = time.monotonic()
                 
-                cache_dir = "/models/.cache"
-                repo_id = current_monitor['repo_id']
-                local_dir = current_monitor['local_dir']
                 total_expected_bytes = current_monitor['total_expected_bytes']
                 
-                # Calculate current downloaded bytes
-                downloaded_bytes = calculate_downloaded_size(local_dir, cache_dir, repo_id)
+                # Calculate current downloaded bytes: per expected file once the file
+                # list is known (finished files are not re-checked), otherwise by
+                # (incrementally) walking the directories
+                active_file = None
+                if current_monitor.get('expected_files'):
+                    downloaded_bytes, active_file = calculate_expected_progress(
+                        current_monitor['local_dir'], "/models/.cache",
+                        current_monitor['repo_id'], current_monitor['expected_files'],
+                        current_monitor['completed_files']
+                    )
+                else:
+                    downloaded_bytes = current_monitor['tracker'].poll()
                 
                 # Calculate progress
                 if total_expected_bytes > 0:
-                    progress = min(95, (downloaded_bytes / total_expected_bytes) * 100)
+                    # Per-file measurement is exact, so only the final copy into
+                    # local_dir is left once every byte is in; keep 100 for 'completed'
+                    cap = 99 if current_monitor.get('expected_files') else 95
+                    progress = min(cap, (downloaded_bytes / total_expected_bytes) * 100)
                     progress_info = f"{get_file_size_from_bytes(downloaded_bytes)} / {get_file_size_from_bytes(total_expected_bytes)}"
                 else:
                     progress = min(95, 10 + (downloaded_bytes / (1024 * 1024 * 100)))
@@ -75,7 +100,12 @@ def monitoring_service_process(status_queue, monitor_requests_queue):
                 
                 # Determine status
                 is_progressing = downloaded_bytes > last_downloaded_bytes
-                status_msg = "Downloading..." if is_progressing else "Processing..."
+                if not is_progressing:
+                    status_msg = "Processing..."
+                elif active_file:
+                    status_msg = f"Downloading {os.path.basename(active_file)}..."
+                else:
+                    status_msg = "Downloading..."
                 
                 # Send updated status
                 status_update = {
@@ -83,20 +113,18 @@ def monitoring_service_process(status_queue, monitor_requests_queue):
                     'status': 'downloading',
                     'current_file': f"{status_msg} ({progress_info})",
                     'downloaded_bytes': downloaded_bytes,
-                    'monitor_time': time.time() - loop_start
+                    'monitor_time': time.monotonic() - loop_start
                 }
+                if current_monitor.get('expected_files'):
+                    status_update['downloaded_files'] = len(current_monitor['completed_files'])
                 
                 status_queue.put(status_update)
                 last_downloaded_bytes = downloaded_bytes
                 
-                print(f"📊 Progress: {progress:.1f}% - {progress_info}")
-            
-            # Sleep for monitoring interval
-            time.sleep(3)  # Monitor every 3 seconds
+                log.debug("📊 Progress: %.1f%% - %s", progress, progress_info)
             
         except Exception as e:
-            print(f"❌ Error in monitoring service: {e}")
-            traceback.print_exc()
+            log.exception("❌ Error in monitoring service: %s", e)
             time.sleep(5)  # Wait longer on error
 
 
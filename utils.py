@@ -6,180 +6,473 @@ Common functions used across multiple modules
 
 import os
 import re
+import logging
+import functools
+import time
 import datetime
-from collections import defaultdict
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
+# File extensions treated as model weights
+MODEL_EXTENSIONS = ('.safetensors', '.bin', '.gguf', '.pt', '.pth')
+
+# Sharded checkpoint names, e.g. model-00001-of-00003.safetensors
+_RE_SAFETENSORS = re.compile(r'(.+)-(\d+)-of-(\d+)\.safetensors\Z')
+_RE_PT_BIN = re.compile(r'pytorch_model-(\d+)-of-(\d+)\.bin\Z')
+
+# Hub repository IDs: owner/name using letters, digits, '-', '_' and '.',
+# each part at most 96 characters (the Hub's limit)
+_RE_REPO_ID = re.compile(r'[\w.-]{1,96}/[\w.-]{1,96}', re.ASCII)
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+# Directories ensure_dir() has already created in this process
+_ensured_dirs = set()
+
+
+def setup_logging():
+    """Configure logging for the current process (level from HFD_LOG, default INFO)
+    
+    Per-request and per-tick messages are logged at DEBUG, so they cost
+    nothing unless HFD_LOG=DEBUG is set.
+    """
+    level = os.environ.get("HFD_LOG", "INFO").upper()
+    logging.basicConfig(level=getattr(logging, level, logging.INFO), format="%(message)s")
+
+
+def ensure_dir(path):
+    """os.makedirs(path, exist_ok=True), skipped for directories already ensured"""
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+def forget_dir(path):
+    """Drop path and everything below it from ensure_dir()'s memory after deleting it"""
+    prefix = path.rstrip('/') + '/'
+    _ensured_dirs.difference_update([p for p in _ensured_dirs if p == path or p.startswith(prefix)])
+
+
+@functools.lru_cache(maxsize=4096)
 def get_file_size_from_bytes(size_bytes):
     """Convert bytes to human readable format"""
     if size_bytes == 0:
         return '0 B'
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.1f} PB"
+    # Unit index straight from the bit length: 1024**i <= size < 1024**(i + 1)
+    i = min(len(SIZE_UNITS) - 1, max(0, (int(size_bytes).bit_length() - 1) // 10))
+    return f"{size_bytes / (1 << (10 * i)):.1f} {SIZE_UNITS[i]}"
 
 
+@functools.lru_cache(maxsize=1024)
 def validate_repo_id(repo_id):
     """Validate repository ID format"""
-    if not repo_id or not isinstance(repo_id, str):
+    if not isinstance(repo_id, str) or not _RE_REPO_ID.fullmatch(repo_id):
         return False
-    if '/' not in repo_id or ' ' in repo_id:
-        return False
-    parts = repo_id.split('/')
-    if len(parts) != 2 or not all(parts):
-        return False
-    return True
+    # '.' and '..' are valid characters but would escape /models/<repo_id>
+    return not any(part in ('.', '..') for part in repo_id.split('/'))
 
 
+@functools.lru_cache(maxsize=1024)
 def validate_model_path(model_path):
     """Validate that the model path is safe to delete"""
-    if not model_path or not isinstance(model_path, str):
-        return False
-    if not model_path.startswith('/models/'):
+    if not isinstance(model_path, str) or not model_path.startswith('/models/'):
         return False
-    normalized_path = os.path.normpath(model_path)
-    if not normalized_path.startswith('/models/') or normalized_path in ['/models', '/models/']:
-        return False
-    return True
+    # Must name something below /models, without any '..' component
+    parts = [part for part in model_path[len('/models/'):].split('/') if part not in ('', '.')]
+    return bool(parts) and '..' not in parts
 
 
-def group_model_files(files):
-    """Group model files by common patterns"""
-    groups = defaultdict(list)
-    ungrouped = []
+def _group_key(file_path):
+    """Return the group pattern for a model file, or None if it stands alone"""
+    filename = os.path.basename(file_path)
     
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        
-        # Pattern for safetensors files like model-00001-of-00003.safetensors
-        safetensors_match = re.match(r'(.+)-(\d+)-of-(\d+)\.safetensors$', filename)
+    # Pattern for safetensors files like model-00001-of-00003.safetensors
+    # (suffix checks first, so most files never reach a regex)
+    if filename.endswith('.safetensors'):
+        safetensors_match = _RE_SAFETENSORS.match(filename)
         if safetensors_match:
             base_name = safetensors_match.group(1)
             total_parts = safetensors_match.group(3)
-            group_key = f"{base_name}-*-of-{total_parts}.safetensors"
-            groups[group_key].append(file_path)
-            continue
-        
-        # Pattern for GGUF files
-        if filename.endswith('.gguf'):
-            parent_dir = os.path.basename(os.path.dirname(file_path))
-            group_key = f"{parent_dir}/*.gguf"
-            groups[group_key].append(file_path)
+            return f"{base_name}-*-of-{total_parts}.safetensors"
+        return None
+    
+    # Pattern for GGUF files
+    if filename.endswith('.gguf'):
+        parent_dir = os.path.basename(os.path.dirname(file_path))
+        return f"{parent_dir}/*.gguf"
+    
+    # Pattern for pytorch model files
+    if filename.startswith('pytorch_model-') and filename.endswith('.bin'):
+        bin_match = _RE_PT_BIN.match(filename)
+        if bin_match:
+            total_parts = bin_match.group(2)
+            return f"pytorch_model-*-of-{total_parts}.bin"
+    
+    return None
+
+
+def group_model_files(files):
+    """Group model files by common patterns
+    
+    Returns (groups, ungrouped): groups is a list of {'name', 'files'} dicts
+    in first-seen order, ungrouped a list of the remaining paths.
+    """
+    groups = []
+    groups_by_key = {}
+    ungrouped = []
+    
+    for file_path in files:
+        group_key = _group_key(file_path)
+        if group_key is None:
+            ungrouped.append(file_path)
             continue
         
-        # Pattern for pytorch model files
-        if filename.startswith('pytorch_model-') and filename.endswith('.bin'):
-            bin_match = re.match(r'pytorch_model-(\d+)-of-(\d+)\.bin$', filename)
-            if bin_match:
-                total_parts = bin_match.group(2)
-                group_key = f"pytorch_model-*-of-{total_parts}.bin"
-                groups[group_key].append(file_path)
-                continue
-        
-        ungrouped.append(file_path)
+        group = groups_by_key.get(group_key)
+        if group is None:
+            group = groups_by_key[group_key] = {'name': group_key, 'files': []}
+            groups.append(group)
+        group['files'].append(file_path)
     
     return groups, ungrouped
 
 
-def create_file_metadata(file_path):
-    """Create file metadata object"""
+def create_file_metadata(name, path, st_size, st_mtime):
+    """Create file metadata object from already collected stat values"""
     try:
-        size_bytes = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-        mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else 0
-        date_str = datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M') if mtime else ''
-    except Exception:
-        size_bytes, mtime, date_str = 0, 0, ''
+        date_str = datetime.datetime.fromtimestamp(st_mtime).strftime('%Y-%m-%d %H:%M') if st_mtime else ''
+    except (OverflowError, OSError, ValueError):
+        date_str = ''
     
     return {
-        'name': os.path.basename(file_path),
-        'path': file_path,
-        'size': get_file_size_from_bytes(size_bytes),
-        'size_bytes': size_bytes,
-        'mtime': mtime,
+        'name': name,
+        'path': path,
+        'size': get_file_size_from_bytes(st_size),
+        'size_bytes': st_size,
+        'mtime': int(st_mtime),  # Whole seconds; the UI shows 'date'
         'date': date_str
     }
 
 
-def calculate_downloaded_size(local_dir, cache_dir, repo_id):
-    """Calculate total bytes downloaded by checking both final and cache directories"""
-    total_downloaded = 0
+def _scan_tree(root):
+    """Yield a DirEntry for every regular file below root (symlinks are not followed)"""
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+                except OSError:
+                    continue
+
+
+def get_directory_size(path):
+    """Total size in bytes of the regular files below path"""
+    total = 0
+    for entry in _scan_tree(path):
+        try:
+            total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return total
+
+
+def _cache_repo_dir(cache_dir, repo_id):
+    """Path of a repository inside the huggingface_hub cache"""
+    return os.path.join(cache_dir, f"models--{repo_id.replace('/', '--')}")
+
+
+def calculate_expected_progress(local_dir, cache_dir, repo_id, expected_files, completed=None):
+    """Return (bytes downloaded, file in progress) for a known list of (rfilename, size, blob_name) files
+    
+    Each file counts once, as the larger of its cache blob and its
+    in-progress .incomplete blob, capped at the expected size. Copies in
+    local_dir are only made from finished blobs and may be left over from
+    an older revision (on update), so they are only used for files without
+    a blob name, and then only count as finished at exactly the expected
+    size. Blobs of older revisions are ignored as well.
+    
+    If a completed set is passed, files that reached their full size are
+    added to it and are not stat'ed again on later calls. The file in
+    progress is the first one found partially downloaded (or None).
+    """
+    blobs_dir = os.path.join(_cache_repo_dir(cache_dir, repo_id), 'blobs')
+    total = 0
+    active = None
+    for rfilename, size, blob_name in expected_files:
+        if completed is not None and rfilename in completed:
+            total += size
+            continue
+        
+        if blob_name:
+            blob_path = os.path.join(blobs_dir, blob_name)
+            candidates = [blob_path, blob_path + '.incomplete']
+        else:
+            candidates = [os.path.join(local_dir, rfilename)]
+        
+        done = 0
+        for path in candidates:
+            try:
+                done = max(done, os.stat(path).st_size)
+            except OSError:
+                continue
+        finished = done >= size if blob_name else done == size
+        if finished:
+            if completed is not None:
+                completed.add(rfilename)
+        elif 0 < done and active is None:
+            active = rfilename
+        total += min(done, size)
+    return total, active
+
+
+class DownloadSizeTracker:
+    """Incrementally track the bytes downloaded for one repository
+    
+    Counts the regular files below local_dir and the repository's cache
+    directory (snapshot symlinks are skipped). State is kept between
+    polls: a directory whose mtime is unchanged is not re-read, and of its
+    files only the ones still changing at the previous poll (or named
+    *.incomplete) are stat'ed again. Steady-state cost is one stat per
+    directory plus one per file actively being written.
+    """
     
-    # Check final destination files
-    if os.path.exists(local_dir):
-        local_path = Path(local_dir)
-        for file_path in local_path.rglob('*'):
-            if file_path.is_file():
+    def __init__(self, local_dir, cache_dir, repo_id):
+        self.roots = (local_dir, _cache_repo_dir(cache_dir, repo_id))
+        # {directory: (mtime_ns, [subdirectories], {file: [size, mtime_ns, changing]})}
+        self._dirs = {}
+    
+    @staticmethod
+    def _observe(path, st, previous):
+        """Build the [size, mtime_ns, changing] record for a file"""
+        changing = (
+            previous is None
+            or previous[0] != st.st_size
+            or previous[1] != st.st_mtime_ns
+            or path.endswith('.incomplete')
+        )
+        return [st.st_size, st.st_mtime_ns, changing]
+    
+    def _read_dir(self, path, previous_files):
+        subdirs = []
+        files = {}
+        with os.scandir(path) as it:
+            for entry in it:
                 try:
-                    total_downloaded += file_path.stat().st_size
-                except (OSError, IOError):
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files[entry.path] = self._observe(entry.path, st, previous_files.get(entry.path))
+                except OSError:
                     continue
+        return subdirs, files
     
-    # Check cache for incomplete files and blobs
-    cache_repo_dir = Path(cache_dir) / f"models--{repo_id.replace('/', '--')}"
-    if cache_repo_dir.exists():
-        for file_path in cache_repo_dir.rglob('*'):
-            if file_path.is_file():
+    def poll(self):
+        """Return the current number of downloaded bytes"""
+        total = 0
+        seen = set()
+        stack = list(self.roots)
+        now_ns = time.time_ns()
+        
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(path)
+            
+            cached = self._dirs.get(path)
+            if cached and cached[0] == mtime_ns:
+                _, subdirs, files = cached
+                for file_path, record in files.items():
+                    if record[2]:
+                        try:
+                            st = os.stat(file_path, follow_symlinks=False)
+                        except OSError:
+                            continue
+                        files[file_path] = self._observe(file_path, st, record)
+            else:
                 try:
-                    total_downloaded += file_path.stat().st_size
-                except (OSError, IOError):
+                    subdirs, files = self._read_dir(path, cached[2] if cached else {})
+                except OSError:
                     continue
+                # A directory modified within the last second may change again
+                # without its mtime moving, so only trust it once it is older
+                trusted_mtime = mtime_ns if now_ns - mtime_ns > 1_000_000_000 else None
+                self._dirs[path] = (trusted_mtime, subdirs, files)
+            
+            total += sum(record[0] for record in files.values())
+            stack.extend(subdirs)
+        
+        for stale in self._dirs.keys() - seen:
+            del self._dirs[stale]
+        
+        return total
+
+
+# scan_models cache: {directory: (mtime_ns, subdirectories, model_info)}
+_model_cache = {}
+
+# Top-level model directories are scanned in parallel (the work is syscall-bound)
+_scan_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='scan_models')
+
+# Directories with files modified more recently than this may still be
+# growing in place, so they are rescanned rather than cached
+MODEL_CACHE_SETTLE_SECONDS = 60
+
+# (ids of the model_info dicts, list) of the last scan_models() result
+_last_scan = ((), [])
+
+
+def _build_model_info(models_dir, root, model_files):
+    """Build the model_info dict for one directory of model files
+    
+    model_files is a list of (path, st_size, st_mtime) tuples gathered by
+    the directory walk, so no further stat calls are needed here.
+    """
+    relative_path = os.path.relpath(root, models_dir)
+    
+    file_stats = {path: (st_size, st_mtime) for path, st_size, st_mtime in model_files}
+    
+    def metadata(path):
+        return create_file_metadata(os.path.basename(path), path, *file_stats[path])
+    
+    # Group files
+    groups, ungrouped = group_model_files(list(file_stats))
+    
+    model_info = {
+        'name': relative_path,
+        'path': root,
+        'groups': groups,
+        'individual_files': []
+    }
     
-    return total_downloaded
+    # Fill in grouped file metadata and totals
+    for group in groups:
+        file_objs = [metadata(fpath) for fpath in group['files']]
+        total_size = sum(f['size_bytes'] for f in file_objs)
+        
+        group['files'] = file_objs
+        group['count'] = len(file_objs)
+        group['size'] = get_file_size_from_bytes(total_size)
+        group['size_bytes'] = total_size
+    
+    # Add individual files
+    model_info['individual_files'] = [metadata(fpath) for fpath in ungrouped]
+    
+    # Calculate total size
+    total_size = sum(st_size for st_size, _ in file_stats.values())
+    model_info['total_size'] = get_file_size_from_bytes(total_size)
+    model_info['total_size_bytes'] = total_size
+    
+    return model_info
+
+
+def _read_model_dir(models_dir, path):
+    """Return (subdirectories, model_info) for one directory, using the cache when its mtime is unchanged"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    
+    cached = _model_cache.get(path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1], cached[2]
+    
+    subdirs = []
+    model_files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(MODEL_EXTENSIONS) and entry.is_file():
+                try:
+                    st = entry.stat()
+                    model_files.append((entry.path, st.st_size, st.st_mtime))
+                except OSError:
+                    model_files.append((entry.path, 0, 0))
+    
+    model_info = _build_model_info(models_dir, path, model_files) if model_files else None
+    
+    newest = max((st_mtime for _, _, st_mtime in model_files), default=0)
+    if time.time() - newest > MODEL_CACHE_SETTLE_SECONDS:
+        _model_cache[path] = (mtime_ns, subdirs, model_info)
+    
+    return subdirs, model_info
+
+
+def invalidate_model_cache(path):
+    """Make scan_models() re-read path and everything below it
+    
+    Needed after a download: huggingface_hub rewrites existing files in
+    place, which leaves the directory mtime (the cache key) unchanged.
+    """
+    prefix = path.rstrip('/') + '/'
+    for cached in [p for p in _model_cache if p == path or p.startswith(prefix)]:
+        _model_cache.pop(cached, None)
+
+
+def _scan_model_tree(models_dir, path):
+    """Scan a directory tree, returning (models, visited directories)"""
+    models = []
+    seen = set()
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            subdirs, model_info = _read_model_dir(models_dir, current)
+        except OSError:
+            continue
+        seen.add(current)
+        if model_info:
+            models.append(model_info)
+        stack.extend(subdirs)
+    return models, seen
 
 
 def scan_models():
-    """Scan /models directory for existing models"""
+    """Scan /models directory for existing models
+    
+    Directories are only re-read when their mtime changes; unchanged
+    directories reuse the cached file listing and metadata. Top-level
+    directories are scanned concurrently on _scan_executor.
+    """
     models_dir = "/models"
-    if not os.path.exists(models_dir):
+    try:
+        subdirs, model_info = _read_model_dir(models_dir, models_dir)
+    except OSError:
         return []
     
-    models = []
+    models = [model_info] if model_info else []
+    seen = {models_dir}
     
-    for root, dirs, files in os.walk(models_dir):
-        if files:
-            # Get model files (common extensions)
-            model_files = [
-                os.path.join(root, file) for file in files
-                if any(file.endswith(ext) for ext in ['.safetensors', '.bin', '.gguf', '.pt', '.pth'])
-            ]
-            
-            if model_files:
-                relative_path = os.path.relpath(root, models_dir)
-                
-                # Group files
-                groups, ungrouped = group_model_files(model_files)
-                
-                model_info = {
-                    'name': relative_path,
-                    'path': root,
-                    'groups': [],
-                    'individual_files': []
-                }
-                
-                # Add grouped files
-                for group_name, group_files in groups.items():
-                    file_objs = [create_file_metadata(fpath) for fpath in group_files]
-                    total_size = sum(f['size_bytes'] for f in file_objs)
-                    
-                    model_info['groups'].append({
-                        'name': group_name,
-                        'files': file_objs,
-                        'count': len(file_objs),
-                        'size': get_file_size_from_bytes(total_size),
-                        'size_bytes': total_size
-                    })
-                
-                # Add individual files
-                model_info['individual_files'] = [create_file_metadata(fpath) for fpath in ungrouped]
-                
-                # Calculate total size
-                total_size = sum(os.path.getsize(f) for f in model_files if os.path.exists(f))
-                model_info['total_size'] = get_file_size_from_bytes(total_size)
-                model_info['total_size_bytes'] = total_size
-                
-                models.append(model_info)
-    
-    return sorted(models, key=lambda x: x['name'])
\ No newline at end of file
+    # Skip the huggingface_hub cache: its snapshot links would list every
+    # downloaded repo a second time, and its blob store is the largest subtree
+    cache_dir = os.path.join(models_dir, '.cache')
+    futures = [
+        _scan_executor.submit(_scan_model_tree, models_dir, subdir)
+        for subdir in subdirs if subdir != cache_dir
+    ]
+    for future in as_completed(futures):
+        sub_models, sub_seen = future.result()
+        models.extend(sub_models)
+        seen.update(sub_seen)
+    
+    # Drop cache entries for directories that no longer exist
+    for stale in _model_cache.keys() - seen:
+        _model_cache.pop(stale, None)
+    
+    # Return the previous list object when it holds exactly the same model_info
+    # dicts, so callers can reuse anything derived from it (e.g. serialized JSON).
+    # _last_scan keeps those dicts alive, so their ids cannot be reused meanwhile.
+    global _last_scan
+    models.sort(key=lambda x: x['name'])
+    key = tuple(map(id, models))
+    if key != _last_scan[0]:
+        _last_scan = (key, models)
+    return _last_scan[1]